@@ -88,8 +88,9 @@ elif args.architecture == "resnet18":
 
     forward = hk.transform_with_state(forward)
     init_fn = partial(forward.init, is_training=True)
-    apply_fn_train = partial(forward.apply, is_training=True)
-    apply_fn_eval = partial(forward.apply, is_training=False)
+    jit_apply = jit(forward.apply, static_argnames=('is_training',))
+    apply_fn_train = partial(jit_apply, is_training=True)
+    apply_fn_eval = partial(jit_apply, is_training=False)
 elif args.architecture == "vgg11":
     pass
 else:
@@ -36,6 +36,7 @@ parser.add_argument('--batch_size', type=int, default=100)
 parser.add_argument('--inverse', action="store_true", default=False)
 parser.add_argument('--no_bn', action="store_true", default=False)
 parser.add_argument('--fix_up', action="store_true", default=False)
+parser.add_argument('--mixed_precision', action="store_true", default=False)
 parser.add_argument('--use_dropout', action="store_true", default=False)
 parser.add_argument('--dropout_rate', type=float, default=0.0)
 parser.add_argument('--element_wise', action="store_true", default=False)
@@ -89,6 +90,8 @@ if args.architecture == "lenet":
     apply_fn_train = apply_fn
     apply_fn_eval = apply_fn
 elif args.architecture == "resnet18":
+    if args.mixed_precision:
+        resnet_mod.set_mixed_precision_policy()
     if args.train_size < 3000 and not args.aug:
         def forward(x, is_training):
             net = resnet_mod.ResNet18(10, use_bn=not args.no_bn, fix_up=args.fix_up, resnet_v1=True)
@@ -100,8 +103,9 @@ elif args.architecture == "resnet18":
 
     forward = hk.transform_with_state(forward)
     init_fn = partial(forward.init, is_training=True)
-    apply_fn_train = partial(forward.apply, is_training=True)
-    apply_fn_eval = partial(forward.apply, is_training=False)
+    jit_apply = jit(forward.apply, static_argnames=('is_training',))
+    apply_fn_train = partial(jit_apply, is_training=True)
+    apply_fn_eval = partial(jit_apply, is_training=False)
 elif args.architecture == "vgg11":
     pass
 elif args.architecture == 'protein':
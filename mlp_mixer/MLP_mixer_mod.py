@@ -1,18 +1,71 @@
-from typing import Any
+from typing import Any, Callable
 
-import einops
 import flax.linen as nn
 import jax.numpy as jnp
+from jax import lax
+
+
+class PooledLayerNorm(nn.Module):
+    """LayerNorm over the last axis followed by a mean over ``axis``.
+
+    Scale and bias are applied once after pooling, which gives the same result
+    as ``jnp.mean(nn.LayerNorm()(x), axis)``. As in ``nn.LayerNorm``, statistics
+    are computed in at least float32 and parameter names are ``scale``/``bias``.
+    """
+    epsilon: float = 1e-6
+    axis: int = 1
+
+    @nn.compact
+    def __call__(self, x):
+        x = jnp.asarray(x, jnp.promote_types(x.dtype, jnp.float32))
+        scale = self.param('scale', nn.initializers.ones, (x.shape[-1],))
+        bias = self.param('bias', nn.initializers.zeros, (x.shape[-1],))
+        mean = jnp.mean(x, axis=-1, keepdims=True)
+        mean2 = jnp.mean(jnp.square(x), axis=-1, keepdims=True)
+        var = jnp.maximum(mean2 - jnp.square(mean), 0.)
+        y = jnp.mean((x - mean) * lax.rsqrt(var + self.epsilon), axis=self.axis)
+        return y * scale + bias
 
 
 class MlpBlock(nn.Module):
     mlp_dim: int
+    out_dim: int
 
     @nn.compact
     def __call__(self, x):
         y = nn.Dense(self.mlp_dim)(x)
-        y = nn.gelu(y)
-        return nn.Dense(x.shape[-1])(y)
+        y = nn.gelu(y, approximate=False)
+        return nn.Dense(self.out_dim)(y)
+
+
+class TokenDense(nn.Module):
+    """Dense layer applied along the token axis of an (N, T, C) input.
+
+    Parameters have the same names and shapes as ``nn.Dense`` applied to the
+    token-transposed input, so pretrained checkpoints load unchanged.
+    """
+    features: int
+    kernel_init: Callable = nn.initializers.lecun_normal()
+    bias_init: Callable = nn.initializers.zeros
+
+    @nn.compact
+    def __call__(self, x):
+        kernel = self.param('kernel', self.kernel_init, (x.shape[1], self.features))
+        bias = self.param('bias', self.bias_init, (self.features,))
+        y = jnp.einsum('ntc,tu->nuc', x, kernel)
+        return y + bias[:, None]
+
+
+class TokenMlpBlock(nn.Module):
+    """MlpBlock over the token axis, without transposing the input."""
+    mlp_dim: int
+    out_dim: int
+
+    @nn.compact
+    def __call__(self, x):
+        y = TokenDense(self.mlp_dim, name='Dense_0')(x)
+        y = nn.gelu(y, approximate=False)
+        return TokenDense(self.out_dim, name='Dense_1')(y)
 
 
 class MixerBlock(nn.Module):
@@ -23,12 +76,17 @@ class MixerBlock(nn.Module):
     @nn.compact
     def __call__(self, x):
         y = nn.LayerNorm()(x)
-        y = jnp.swapaxes(y, 1, 2)
-        y = MlpBlock(self.tokens_mlp_dim, name='token_mixing')(y)
-        y = jnp.swapaxes(y, 1, 2)
+        y = TokenMlpBlock(self.tokens_mlp_dim, out_dim=y.shape[1], name='token_mixing')(y)
         x = x + y
         y = nn.LayerNorm()(x)
-        return x + MlpBlock(self.channels_mlp_dim, name='channel_mixing')(y)
+        return x + MlpBlock(self.channels_mlp_dim, out_dim=y.shape[-1], name='channel_mixing')(y)
+
+
+class ScanMixerBlock(MixerBlock):
+    """MixerBlock with the (carry, x) -> (carry, y) signature used by nn.scan."""
+
+    def __call__(self, x, _):
+        return super().__call__(x), None
 
 
 class MlpMixer(nn.Module):
@@ -39,15 +97,20 @@ class MlpMixer(nn.Module):
     hidden_dim: int
     tokens_mlp_dim: int
     channels_mlp_dim: int
+    remat: bool = False
 
     @nn.compact
     def __call__(self, inputs):
         x = nn.Conv(self.hidden_dim, self.patches,
                     strides=self.patches, name='stem')(inputs)
-        x = einops.rearrange(x, 'n h w c -> n (h w) c')
-        for _ in range(self.num_blocks):
-            x = MixerBlock(self.tokens_mlp_dim, self.channels_mlp_dim)(x)
-        x = nn.LayerNorm(name='pre_head_layer_norm')(x)
-        x = jnp.mean(x, axis=1)
+        x = x.reshape(x.shape[0], -1, x.shape[-1])
+        # Rematerialised blocks keep only their inputs for the backward pass.
+        block = nn.remat(ScanMixerBlock, prevent_cse=False) if self.remat else ScanMixerBlock
+        x, _ = nn.scan(block,
+                       variable_axes={'params': 0},
+                       split_rngs={'params': True},
+                       length=self.num_blocks)(self.tokens_mlp_dim, self.channels_mlp_dim,
+                                               name='mixer_blocks')(x, None)
+        x = PooledLayerNorm(axis=1, name='pre_head_layer_norm')(x)
         return nn.Dense(self.num_classes, kernel_init=nn.initializers.zeros,
                         name='head')(x)
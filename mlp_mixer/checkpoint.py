@@ -17,6 +17,7 @@ import collections
 from absl import logging
 import flax
 from flax.training import checkpoints
+import jax
 import jax.numpy as jnp
 import numpy as np
 import pandas as pd
@@ -113,6 +114,16 @@ def load(path):
     return params
 
 
+def stack_mixer_blocks(params):
+    """Stacks per-block `MixerBlock_{i}` subtrees into the scanned `mixer_blocks` layout."""
+    block_keys = sorted((k for k in params if k.startswith('MixerBlock_')),
+                        key=lambda k: int(k.split('_')[-1]))
+    if block_keys:
+        blocks = [params.pop(k) for k in block_keys]
+        params['mixer_blocks'] = jax.tree_util.tree_map(lambda *xs: np.stack(xs), *blocks)
+    return params
+
+
 def load_pretrained(pretrained_path, init_params):
     """Loads/converts a pretrained checkpoint for fine tuning.
   Args:
@@ -127,7 +138,7 @@ def load_pretrained(pretrained_path, init_params):
   """
 
     restored_params = inspect_params(
-        params=load(pretrained_path),
+        params=stack_mixer_blocks(load(pretrained_path)),
         expected=init_params,
         fail_if_extra=False,
         fail_if_missing=False)
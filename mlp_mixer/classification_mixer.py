@@ -82,7 +82,8 @@ net = MLP_mixer_mod.MlpMixer(patches=[16, 16],
                              num_blocks=12,
                              hidden_dim=768,
                              tokens_mlp_dim=384,
-                             channels_mlp_dim=3072)
+                             channels_mlp_dim=3072,
+                             remat=True)
 init_state, init_params = net.init(rng_key, x_init).pop('params')
 
 # pretrained_path = '/home/xzhoubi/hudson/function_map/ckpts/imagenet1k_Mixer-B_16.npz'
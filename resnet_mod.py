@@ -1,3 +1,4 @@
+import functools
 import types
 from typing import Mapping, Optional, Sequence, Union, Any
 
@@ -8,6 +9,7 @@ from haiku._src import module
 from haiku._src import pool
 import jax
 import jax.numpy as jnp
+import jmp
 
 import haiku as hk
 # hk = types.ModuleType("haiku")
@@ -22,29 +24,26 @@ FloatStrOrBool = Union[str, float, bool]
 
 
 class BlockV1(hk.Module):
-    """ResNet V1 block with optional bottleneck."""
+    """Base ResNet V1 block with optional bottleneck.
+
+    Holds the convolutions and fix-up parameters of the block; use
+    :class:`BlockV1BN` or :class:`BlockV1NoBN`, which implement the forward pass
+    with and without batch norm.
+    """
 
     def __init__(
             self,
             channels: int,
             stride: Union[int, Sequence[int]],
             use_projection: bool,
-            bn_config: Mapping[str, FloatStrOrBool],
             bottleneck: bool,
-            use_bn: bool,
             fix_up: bool,
             name: Optional[str] = None,
     ):
         super().__init__(name=name)
         self.use_projection = use_projection
-        self.use_bn = use_bn
         self.fix_up = fix_up
 
-        bn_config = dict(bn_config)
-        bn_config.setdefault("create_scale", True)
-        bn_config.setdefault("create_offset", True)
-        bn_config.setdefault("decay_rate", 0.999)
-
         if self.use_projection:
             self.proj_conv = hk.Conv2D(
                 output_channels=channels,
@@ -52,71 +51,115 @@ class BlockV1(hk.Module):
                 stride=stride,
                 with_bias=False,
                 padding="SAME",
+                data_format="NHWC",
                 name="shortcut_conv")
 
-            if use_bn:
-                self.proj_batchnorm = hk.BatchNorm(name="shortcut_batchnorm", **bn_config)
-
         channel_div = 4 if bottleneck else 1
-        conv_0 = hk.Conv2D(
+        self.conv_0 = hk.Conv2D(
             output_channels=channels // channel_div,
             kernel_shape=1 if bottleneck else 3,
             stride=1 if bottleneck else stride,
             with_bias=False,
             padding="SAME",
+            data_format="NHWC",
             name="conv_0")
 
-        if use_bn:
-            bn_0 = hk.BatchNorm(name="batchnorm_0", **bn_config)
-
-        conv_1 = hk.Conv2D(
+        self.conv_1 = hk.Conv2D(
             output_channels=channels // channel_div,
             kernel_shape=3,
             stride=stride if bottleneck else 1,
             with_bias=False,
             padding="SAME",
+            data_format="NHWC",
             name="conv_1")
 
-        if use_bn:
-            bn_1 = hk.BatchNorm(name="batchnorm_1", **bn_config)
-            layers = ((conv_0, bn_0), (conv_1, bn_1))
-        else:
-            layers = ((conv_0, None), (conv_1, None))
-
-        self.layers = layers
-
-    def __call__(self, inputs, is_training, test_local_stats):
+    def fix_up_params(self):
+        """Returns the scalar fix-up parameters ``bias_1a, bias_1b, bias_2a, bias_2b, scale``."""
         bias_1a = hk.get_parameter("bias_1a", shape=[], init=jnp.zeros)
         bias_1b = hk.get_parameter("bias_1b", shape=[], init=jnp.zeros)
         bias_2a = hk.get_parameter("bias_2a", shape=[], init=jnp.zeros)
         bias_2b = hk.get_parameter("bias_2b", shape=[], init=jnp.zeros)
         scale = hk.get_parameter("scale", shape=[], init=jnp.ones)
+        return bias_1a, bias_1b, bias_2a, bias_2b, scale
+
+
+class BlockV1BN(BlockV1):
+    """ResNet V1 block with batch norm after every convolution."""
+
+    def __init__(
+            self,
+            channels: int,
+            stride: Union[int, Sequence[int]],
+            use_projection: bool,
+            bn_config: Mapping[str, FloatStrOrBool],
+            bottleneck: bool,
+            fix_up: bool,
+            name: Optional[str] = None,
+    ):
+        super().__init__(channels=channels,
+                         stride=stride,
+                         use_projection=use_projection,
+                         bottleneck=bottleneck,
+                         fix_up=fix_up,
+                         name=name)
+
+        bn_config = dict(bn_config)
+        bn_config.setdefault("create_scale", True)
+        bn_config.setdefault("create_offset", True)
+        bn_config.setdefault("decay_rate", 0.999)
+        bn_config.setdefault("data_format", "channels_last")
+
+        if self.use_projection:
+            self.proj_batchnorm = hk.BatchNorm(name="shortcut_batchnorm", **bn_config)
+        self.bn_0 = hk.BatchNorm(name="batchnorm_0", **bn_config)
+        self.bn_1 = hk.BatchNorm(name="batchnorm_1", **bn_config)
+
+    def __call__(self, inputs, is_training, test_local_stats):
+        bias_1a, bias_1b, bias_2a, bias_2b, scale = self.fix_up_params()
 
         out = shortcut = inputs
 
         if self.use_projection:
             shortcut = self.proj_conv(shortcut)
-            if self.use_bn:
-                shortcut = self.proj_batchnorm(shortcut, is_training, test_local_stats)
+            shortcut = self.proj_batchnorm(shortcut, is_training, test_local_stats)
 
-        for i, (conv_i, bn_i) in enumerate(self.layers):
-            out = conv_i(out)
-            if self.fix_up and i == 0:
-                out = out + bias_1a
-            if self.fix_up and i == 1:
-                out = out + bias_2a
+        out = self.conv_0(out)
+        if self.fix_up:
+            out = out + bias_1a
+        out = self.bn_0(out, is_training, test_local_stats)
+        if self.fix_up:
+            out = out + bias_1b
+        out = jax.nn.relu(out)
 
-            if self.use_bn:
-                out = bn_i(out, is_training, test_local_stats)
+        out = self.conv_1(out)
+        if self.fix_up:
+            out = out + bias_2a
+        out = self.bn_1(out, is_training, test_local_stats)
+        if self.fix_up:
+            out = out * scale + bias_2b
+
+        return jax.nn.relu(out + shortcut)
 
-            if i == 0:
-                if self.fix_up:
-                    out = out + bias_1b
-                out = jax.nn.relu(out)
 
-            if i == 1:
-                if self.fix_up:
-                    out = out * scale + bias_2b
+class BlockV1NoBN(BlockV1):
+    """ResNet V1 block without batch norm."""
+
+    def __call__(self, inputs, is_training, test_local_stats):
+        bias_1a, bias_1b, bias_2a, bias_2b, scale = self.fix_up_params()
+
+        out = shortcut = inputs
+
+        if self.use_projection:
+            shortcut = self.proj_conv(shortcut)
+
+        out = self.conv_0(out)
+        if self.fix_up:
+            out = out + bias_1a + bias_1b
+        out = jax.nn.relu(out)
+
+        out = self.conv_1(out)
+        if self.fix_up:
+            out = (out + bias_2a) * scale + bias_2b
 
         return jax.nn.relu(out + shortcut)
 
@@ -139,7 +182,10 @@ class BlockGroup(hk.Module):
     ):
         super().__init__(name=name)
         self.use_bn = use_bn
-        block_cls = BlockV1
+        if use_bn:
+            block_cls = functools.partial(BlockV1BN, bn_config=bn_config)
+        else:
+            block_cls = BlockV1NoBN
 
         self.blocks = []
         for i in range(num_blocks):
@@ -148,8 +194,6 @@ class BlockGroup(hk.Module):
                           stride=(1 if i else stride),
                           use_projection=use_projection,
                           bottleneck=bottleneck,
-                          bn_config=bn_config,
-                          use_bn=use_bn,
                           fix_up=fix_up,
                           name="block_%d" % (i)))
 
@@ -169,7 +213,8 @@ class ResNet(hk.Module):
     """ResNet model."""
 
     BlockGroup = BlockGroup  # pylint: disable=invalid-name
-    BlockV1 = BlockV1  # pylint: disable=invalid-name
+    BlockV1BN = BlockV1BN  # pylint: disable=invalid-name
+    BlockV1NoBN = BlockV1NoBN  # pylint: disable=invalid-name
 
     def __init__(
             self,
@@ -194,7 +239,10 @@ class ResNet(hk.Module):
       num_classes: The number of classes to classify the inputs into.
       bn_config: A dictionary of two elements, ``decay_rate`` and ``eps`` to be
         passed on to the :class:`~haiku.BatchNorm` layers. By default the
-        ``decay_rate`` is ``0.9`` and ``eps`` is ``1e-5``.
+        ``decay_rate`` is ``0.9`` and ``eps`` is ``1e-5``. For data-parallel
+        training set ``cross_replica_axis`` to the ``jax.pmap`` axis name, e.g.
+        ``{"cross_replica_axis": "batch"}``, to normalize with the global batch
+        statistics.
       resnet_v2: Whether to use the v1 or v2 ResNet implementation. Defaults to
         ``False``.
       bottleneck: Whether the block should bottleneck or not. Defaults to
@@ -219,6 +267,7 @@ class ResNet(hk.Module):
         bn_config.setdefault("eps", 1e-5)
         bn_config.setdefault("create_scale", True)
         bn_config.setdefault("create_offset", True)
+        bn_config.setdefault("data_format", "channels_last")
 
         logits_config = dict(logits_config or {})
         logits_config.setdefault("w_init", jnp.zeros)
@@ -227,6 +276,7 @@ class ResNet(hk.Module):
         # Number of blocks in each group for ResNet.
         check_length(4, blocks_per_group, "blocks_per_group")
         check_length(4, channels_per_group, "channels_per_group")
+        check_length(4, use_projection, "use_projection")
 
         initial_conv_config = dict(initial_conv_config or {})
         initial_conv_config.setdefault("output_channels", 64)
@@ -240,6 +290,7 @@ class ResNet(hk.Module):
 
         initial_conv_config.setdefault("with_bias", False)
         initial_conv_config.setdefault("padding", "SAME")
+        initial_conv_config.setdefault("data_format", "NHWC")
         initial_conv_config.setdefault("name", "initial_conv")
 
         self.initial_conv = hk.Conv2D(**initial_conv_config)
@@ -249,24 +300,48 @@ class ResNet(hk.Module):
                 self.initial_batchnorm = hk.BatchNorm(name="initial_batchnorm",
                                                   **bn_config)
 
-        self.block_groups = []
-        strides = (1, 2, 2, 2)
-        for i in range(4):
-            self.block_groups.append(
-                BlockGroup(channels=channels_per_group[i],
-                           num_blocks=blocks_per_group[i],
-                           stride=strides[i],
-                           bn_config=bn_config,
-                           resnet_v2=resnet_v2,
-                           bottleneck=bottleneck,
-                           use_projection=use_projection[i],
-                           use_bn=use_bn,
-                           fix_up=fix_up,
-                           name="block_group_%d" % (i)))
+        group_config = dict(bn_config=bn_config,
+                            resnet_v2=resnet_v2,
+                            bottleneck=bottleneck,
+                            use_bn=use_bn,
+                            fix_up=fix_up)
+        self.block_groups = [
+            BlockGroup(channels=channels_per_group[0],
+                       num_blocks=blocks_per_group[0],
+                       stride=1,
+                       use_projection=use_projection[0],
+                       name="block_group_0",
+                       **group_config),
+            BlockGroup(channels=channels_per_group[1],
+                       num_blocks=blocks_per_group[1],
+                       stride=2,
+                       use_projection=use_projection[1],
+                       name="block_group_1",
+                       **group_config),
+            BlockGroup(channels=channels_per_group[2],
+                       num_blocks=blocks_per_group[2],
+                       stride=2,
+                       use_projection=use_projection[2],
+                       name="block_group_2",
+                       **group_config),
+            BlockGroup(channels=channels_per_group[3],
+                       num_blocks=blocks_per_group[3],
+                       stride=2,
+                       use_projection=use_projection[3],
+                       name="block_group_3",
+                       **group_config),
+        ]
 
         self.logits = hk.Linear(num_classes, **logits_config)
 
     def __call__(self, inputs, is_training, test_local_stats=False):
+        """Applies the ResNet to a batch of NHWC images.
+
+    ``is_training`` and ``test_local_stats`` pick the batch norm branch in
+    Python, so they should be static when the transformed apply is jitted, e.g.
+    ``jax.jit(forward.apply, static_argnames=('is_training',))``; each
+    combination then compiles to its own graph without the unused branch.
+    """
         bias_1 = hk.get_parameter("bias_1", shape=[], init=jnp.zeros)
         bias_2 = hk.get_parameter("bias_2", shape=[], init=jnp.zeros)
 
@@ -281,9 +356,12 @@ class ResNet(hk.Module):
             out = out + bias_1
         for block_group in self.block_groups:
             out = block_group(out, is_training, test_local_stats)
-        # out = hk.avg_pool(out, window_shape=4, strides=4, padding='VALID')
-        # out = out.reshape(out.shape[0], -1)
-        out = jnp.mean(out, axis=(1, 2))
+        height, width = out.shape[1:3]
+        out = hk.avg_pool(out,
+                          window_shape=(1, height, width, 1),
+                          strides=(1, 1, 1, 1),
+                          padding="VALID")
+        out = out.reshape(out.shape[0], -1)
         if self.fix_up:
             out = out + bias_2
         return self.logits(out)
@@ -308,7 +386,9 @@ class ResNet18(ResNet):
     Args:
       num_classes: The number of classes to classify the inputs into.
       bn_config: A dictionary of two elements, ``decay_rate`` and ``eps`` to be
-        passed on to the :class:`~haiku.BatchNorm` layers.
+        passed on to the :class:`~haiku.BatchNorm` layers. Set
+        ``cross_replica_axis`` to the ``jax.pmap`` axis name to synchronize
+        batch statistics across devices.
       resnet_v2: Whether to use the v1 or v2 ResNet implementation. Defaults
         to ``False``.
       logits_config: A dictionary of keyword arguments for the logits layer.
@@ -346,3 +426,15 @@ class ResNet18(ResNet):
                          **CONFIGS[18])
 
 
+def set_mixed_precision_policy(compute_dtype: str = "bfloat16"):
+    """Runs ResNet convolutions in ``compute_dtype`` with float32 parameters.
+
+    Parameters stay float32 for the optimizer and are cast to ``compute_dtype``
+    on use; batch norm is computed in float32. Haiku policies are registered
+    per class, so this must be called before the model is transformed.
+    """
+    policy = jmp.get_policy(f"params=float32,compute={compute_dtype},output=float32")
+    bn_policy = jmp.get_policy(f"params=float32,compute=float32,output={compute_dtype}")
+    for cls in (ResNet, ResNet18):
+        hk.mixed_precision.set_policy(cls, policy)
+    hk.mixed_precision.set_policy(hk.BatchNorm, bn_policy)